@@ -0,0 +1,158 @@
+# Basic
+import threading
+import numpy as np
+
+# PostgreSQL database connection
+from sqlalchemy import select
+from sqlalchemy.orm import Session
+
+# Locals
+from CRUD.face.models import Face
+
+# Length of a dlib face feature.
+FEATURE_DIM = 128
+
+# Rows the feature matrix grows by when it is full, so appending a face doesn't copy the whole gallery.
+GROW_ROWS = 1024
+
+# Rows fetched from the database at a time when the gallery is filled.
+LOAD_BATCH_ROWS = 1024
+
+# Simple caching like redis...
+# The gallery is filled once at startup, then kept in sync by upload, update and delete,
+# so it is never stale and never reloaded. Row i of the matrix belongs to face _ids[i].
+# The matrix has spare rows at its end: appending writes into a spare row, and removing
+# swaps the last row in on a copy, so a reader's snapshot never changes under it.
+_ids = []
+_descs = []
+_rows = {}      # Face id -> row.
+_matrix = np.empty((0, FEATURE_DIM), dtype=np.float32)
+_sq_norms = np.empty((0,), dtype=np.float32)
+_snapshot = (_descs, _matrix, _sq_norms)
+_lock = threading.Lock()
+
+
+def _capacity(num_rows: int) -> int:
+    """
+    Get the number of rows to allocate for a gallery of some faces.
+    :param num_rows: Number of faces in the gallery.
+    :return: Number of rows rounded up to a multiple of GROW_ROWS, leaving at least one spare row.
+    """
+    return (num_rows // GROW_ROWS + 1) * GROW_ROWS
+
+
+def _publish():
+    """
+    Swap in the snapshot of the current faces. Must be called with the lock held.
+    """
+    global _snapshot
+    num_rows = len(_ids)
+    _snapshot = (_descs, _matrix[:num_rows], _sq_norms[:num_rows])
+
+
+def load(db: Session):
+    """
+    Fill the gallery of face ids, descriptions and features from the database.
+    :param db: Database session.
+    """
+    global _ids, _descs, _rows, _matrix, _sq_norms
+    with _lock:
+        # Only the columns the gallery needs, as plain Core rows without ORM bookkeeping,
+        # streamed from a server-side cursor so the rows are never all in memory at once.
+        result = db.execute(select(Face.id, Face.description, Face.feature)
+                            .execution_options(yield_per=LOAD_BATCH_ROWS))
+
+        ids, descs, feature_chunks = [], [], []
+        for rows in result.partitions():
+            ids.extend(row.id for row in rows)
+            descs.extend(row.description for row in rows)
+            feature_chunks.append(b"".join(row.feature for row in rows))
+        features = np.frombuffer(b"".join(feature_chunks), dtype=np.float32).reshape(-1, FEATURE_DIM)
+
+        _ids, _descs = ids, descs
+        _rows = {face_id: i for i, face_id in enumerate(_ids)}
+        _matrix = np.empty((_capacity(len(ids)), FEATURE_DIM), dtype=np.float32)
+        _matrix[:len(ids)] = features
+        _sq_norms = np.empty((len(_matrix),), dtype=np.float32)
+        _sq_norms[:len(ids)] = np.einsum("ij,ij->i", features, features)
+        _publish()
+
+
+def snapshot():
+    """
+    Get the current gallery.
+    :return: (descriptions, feature matrix of shape (N, 128), squared row norms of shape (N,)).
+             Take it once per request, so a concurrent upload can't change it halfway.
+    """
+    return _snapshot
+
+
+def size() -> int:
+    """
+    Get the number of faces in the gallery, which is every face in the database.
+    :return: Number of faces.
+    """
+    return len(_snapshot[0])
+
+
+def append(face_id, description, face_feature):
+    """
+    Append a newly uploaded face to the gallery.
+    :param face_id: Id of the new face.
+    :param description: Description of the new face.
+    :param face_feature: Feature of the new face.
+    """
+    global _matrix, _sq_norms
+    row = np.asarray(face_feature, dtype=np.float32)
+    with _lock:
+        num_rows = len(_ids)
+        if num_rows == len(_matrix):
+            matrix = np.empty((_capacity(num_rows), FEATURE_DIM), dtype=np.float32)
+            matrix[:num_rows] = _matrix[:num_rows]
+            sq_norms = np.empty((len(matrix),), dtype=np.float32)
+            sq_norms[:num_rows] = _sq_norms[:num_rows]
+            _matrix, _sq_norms = matrix, sq_norms
+
+        # Readers only see the first `num_rows` rows, so the spare row is written in place.
+        _matrix[num_rows] = row
+        _sq_norms[num_rows] = row @ row
+        _ids.append(face_id)
+        _descs.append(description)
+        _rows[face_id] = num_rows
+        _publish()
+
+
+def remove(face_id):
+    """
+    Remove a deleted face from the gallery. Nothing happens if it isn't in the gallery.
+    :param face_id: Id of the deleted face.
+    """
+    global _ids, _descs, _matrix, _sq_norms
+    with _lock:
+        row = _rows.pop(face_id, None)
+        if row is None:
+            return
+
+        # Readers may still be scoring the current arrays, so the last row is moved into the
+        # removed one on copies. Deletes are rare next to comparisons.
+        _ids, _descs, _matrix, _sq_norms = list(_ids), list(_descs), _matrix.copy(), _sq_norms.copy()
+        last = len(_ids) - 1
+        if row != last:
+            _ids[row], _descs[row] = _ids[last], _descs[last]
+            _matrix[row], _sq_norms[row] = _matrix[last], _sq_norms[last]
+            _rows[_ids[row]] = row
+        _ids.pop()
+        _descs.pop()
+        _publish()
+
+
+def update_description(face_id, description):
+    """
+    Update the description of a face in the gallery. Nothing happens if it isn't in the gallery.
+    :param face_id: Id of the updated face.
+    :param description: New description of the face.
+    """
+    with _lock:
+        row = _rows.get(face_id)
+        if row is not None:
+            _descs[row] = description
@@ -1,32 +1,45 @@
-from sqlalchemy import Column, String, DateTime, LargeBinary, JSON, func
+from sqlalchemy import Column, String, DateTime, LargeBinary, Index, func
 from sqlalchemy.dialects.postgresql import UUID
+from sqlalchemy.orm import deferred
 from sqlalchemy.sql import text
 
 # Root reference
-from database import Base
+from database import Base, uuid7
 
 
 class Face(Base):
     __tablename__ = 'faces'
+    __table_args__ = (
+        # Trigram index, so that find_faces' ILIKE '%...%' doesn't scan every description.
+        # Needs the pg_trgm extension.
+        Index("faces_description_trgm_idx", "description",
+              postgresql_using="gin",
+              postgresql_ops={"description": "gin_trgm_ops"}),
+        # Order of get_faces' pages. The id breaks ties between faces uploaded at the same time.
+        Index("faces_uploaded_at_id_idx", text("uploaded_at DESC"), text("id DESC")),
+    )
 
     id = Column(UUID(as_uuid=True),
                 primary_key=True,
-                default=text("uuid_generate_v4()"),
+                default=uuid7,     # Made here, so the INSERT carries its id.
                 server_default=text("uuid_generate_v4()"),
                 index=True)
 
     uploaded_at = Column(DateTime(timezone=True),
                          default=func.now(),
                          server_default=func.now(),
-                         nullable=False)
+                         nullable=False)    # Indexed with id, see __table_args__.
 
     uploaded_by = Column(UUID(as_uuid=True),
                          primary_key=False,
                          index=True,
                          nullable=False)
 
-    blob = Column(LargeBinary, nullable=False)
+    # The base64 image is by far the largest column. It is only loaded when accessed,
+    # or when a query asks for it with undefer().
+    blob = deferred(Column(LargeBinary, nullable=False))
 
-    feature = Column(JSON, nullable=False)
+    # Raw float32 bytes of the 128-d face feature, i.e. ``np.ndarray.tobytes()``.
+    feature = Column(LargeBinary, nullable=False)
 
     description = Column(String, nullable=True)
@@ -1,18 +1,35 @@
 from uuid import UUID
-from typing import Optional
+from datetime import datetime
+from typing import Optional, List, Annotated
+from pydantic import Field
 
 # Local
 from CRUD.user.schemas import WithUserId
 
+# Longest base64 image accepted, about 7.5 MB decoded. Larger ones are rejected by
+# validation before anything is decoded.
+MAX_BLOB_LENGTH = 10_000_000
+
+# Most images compared in one batch.
+MAX_BATCH_SIZE = 32
+
+# Longest combined base64 of the images of one batch, checked before any of them is decoded.
+MAX_BATCH_BLOB_LENGTH = 4 * MAX_BLOB_LENGTH
+
+ImageBlob = Annotated[bytes, Field(max_length=MAX_BLOB_LENGTH)]
+
 
 class FaceUpload(WithUserId):
-    blob: bytes
+    blob: ImageBlob
     description: Optional[str] = None
 
 
 class FacesGet(WithUserId):
     range_from: int
     range_to: int
+    # Cursor of the previous page: uploaded_at and id of its last face, given together.
+    last_uploaded_at: Optional[datetime] = None
+    last_face_id: Optional[UUID] = None
 
 
 class FaceUpdate(WithUserId):
@@ -33,4 +50,10 @@ class FacesFindByDesc(WithUserId):
 
 
 class FaceCompare(WithUserId):
-    blob: bytes
+    blob: ImageBlob
+    top_k: Optional[int] = None     # Only return the best k matches. All matches if not given.
+
+
+class FacesCompareBatch(WithUserId):
+    blobs: Annotated[List[ImageBlob], Field(max_length=MAX_BATCH_SIZE)]
+    top_k: Optional[int] = None     # Only return the best k matches of each image. All matches if not given.
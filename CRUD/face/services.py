@@ -2,104 +2,314 @@
 import os
 import time
 import base64
-from io import BytesIO
-from typing import cast
-from PIL import Image
+import asyncio
+import threading
+from concurrent.futures import ThreadPoolExecutor
+import warnings
+from uuid import UUID
+from typing import Optional
 import dlib
 import numpy as np
 import cv2
-import magic
 
 # FastAPI server essentials
-from fastapi import APIRouter, Depends, HTTPException, status
+from fastapi import APIRouter, Depends, HTTPException, status, UploadFile, File, Form
+from fastapi.concurrency import run_in_threadpool
 
 # PostgreSQL database connection
-from sqlalchemy import desc
-from sqlalchemy.orm import Session
+from sqlalchemy import desc, select, insert, update, tuple_, literal
+from sqlalchemy.orm import Session, undefer
 
 # Locals
-from database import get_db
+from database import get_db, SessionLocal
+from CRUD.face import gallery
+from CRUD.face.gallery import FEATURE_DIM
 from CRUD.face.models import Face
-from CRUD.face.schemas import FaceUpload, FacesGet, FaceUpdate, FaceDelete, FacesFindByDesc, FaceCompare
+from CRUD.face.schemas import (FaceUpload, FacesGet, FaceUpdate, FaceDelete, FacesFindByDesc, FaceCompare,
+                               FacesCompareBatch, MAX_BLOB_LENGTH, MAX_BATCH_BLOB_LENGTH)
 from CRUD.user.models import WRITE, READ, DELETE, UPDATE
-from query import find_by, _guard_db, get_header_token
+from CRUD.user.schemas import WithUserId
+from query import find_by_pk, _guard_db, get_header_token
 
 router = APIRouter()
 
 ALLOWED_EXTENSIONS = {"png", "jpg", "jpeg"}
 
-# Detect faces in an image.
-face_detector = dlib.get_frontal_face_detector()
+# Largest image file accepted by upload_face_file: the decoded size of the longest base64 blob
+# upload_face accepts, so both upload routes have the same limit.
+MAX_FILE_BYTES = MAX_BLOB_LENGTH // 4 * 3
 
-# Converts Image pixels to landmarks.
+# Bytes of an uploaded file read at a time while its size is checked.
+UPLOAD_CHUNK_BYTES = 1 << 20
+
+# Leading bytes (magic numbers) of the image types we can tell apart.
+FILE_SIGNATURES = {
+    b"\x89PNG\r\n\x1a\n": "png",
+    b"\xff\xd8\xff": "jpeg",
+}
+
+# dlib wheels built without AVX run detection and recognition several times slower.
+if not getattr(dlib, "USE_AVX_INSTRUCTIONS", False):
+    warnings.warn("dlib is not built with AVX instructions. Face detection and recognition will be slow.")
+
+# Requests are already served concurrently, keep OpenCV from spawning its own thread pool on top.
+cv2.setNumThreads(1)
+
+# Converts Image pixels to landmarks. Prediction doesn't modify the model, so all threads share it.
 predictor = dlib.shape_predictor(os.path.join(os.path.dirname(__file__),
                                               "models",
                                               "shape_predictor_68_face_landmarks.dat"))
 
-# Converts landmarks to feature.
-face_rec_model = dlib.face_recognition_model_v1(os.path.join(os.path.dirname(__file__),
-                                                             "models",
-                                                             "dlib_face_recognition_resnet_model_v1.dat"))
+FACE_REC_MODEL_PATH = os.path.join(os.path.dirname(__file__),
+                                   "models",
+                                   "dlib_face_recognition_resnet_model_v1.dat")
+
+# dlib's CNN (MMOD) face detector is more accurate than HOG, and faster on larger images when it
+# runs on a GPU. Use it if dlib is built with CUDA and its model is put next to the others.
+CNN_FACE_DETECTOR_PATH = os.path.join(os.path.dirname(__file__),
+                                      "models",
+                                      "mmod_human_face_detector.dat")
+USE_CNN_DETECTOR = bool(getattr(dlib, "DLIB_USE_CUDA", False)) and os.path.exists(CNN_FACE_DETECTOR_PATH)
+
+# The GPU runs one detection at a time anyway, so the CNN detector is loaded once and shared behind
+# a lock, rather than each thread holding its own copy in GPU memory.
+cnn_face_detector = dlib.cnn_face_detection_model_v1(CNN_FACE_DETECTOR_PATH) if USE_CNN_DETECTOR else None
+_cnn_lock = threading.Lock()
+
+# Feature retrieval is CPU-bound, and dlib releases the GIL while it works, so requests
+# run it on this pool, one thread per core, instead of blocking the event loop.
+# Each thread loads its own models, so FACE_MAX_WORKERS caps the threads, and the memory, on large hosts.
+# os.cpu_count() can be None in some containers.
+CPU_WORKERS = max(1, min(os.cpu_count() or 1, int(os.getenv("FACE_MAX_WORKERS", 8))))
+CPU_POOL = ThreadPoolExecutor(max_workers=CPU_WORKERS)
+
+# CLAHE, face detector and recognition model of each thread.
+_thread_models = threading.local()
+
+
+def _detect_faces(models, image, upsample_num_times: int):
+    """
+    Detect faces in an image, with the CNN detector on the GPU if there is one, otherwise with HOG.
+    :param models: Models of the current thread.
+    :param image: Image to detect faces in.
+    :param upsample_num_times: Number of upsampling before detection.
+    :return: Rectangles of the detected faces.
+    """
+    if cnn_face_detector is None:
+        return models.face_detector(image, upsample_num_times=upsample_num_times)
+    with _cnn_lock:
+        detections = cnn_face_detector(image, upsample_num_times=upsample_num_times)
+    return [detection.rect for detection in detections]
+
+
+def _get_thread_models():
+    """
+    Get the CLAHE, the face detector and the face recognition model of the current thread.
+    They keep working buffers inside the object, so each thread owns a copy instead of
+    sharing one behind a lock, and reuses it across requests.
+    :return: Namespace with ``clahe`` (adaptive histogram equalization),
+             ``face_detector`` (detect faces in an image)
+             and ``face_rec_model`` (converts landmarks to feature).
+    """
+    if not hasattr(_thread_models, "face_detector"):
+        _thread_models.clahe = cv2.createCLAHE(clipLimit=2.0, tileGridSize=(8, 8))
+        _thread_models.face_detector = dlib.get_frontal_face_detector()
+        _thread_models.face_rec_model = dlib.face_recognition_model_v1(FACE_REC_MODEL_PATH)
+    return _thread_models
+
+
+# Longest image side the face detector runs at. Landmarks and features still use the full image.
+DETECT_MAX_SIDE = 640
 
-# Simple caching like redis...
-cached_faces = []
-cache_settle_time = -np.inf
-CACHE_TTL = 30
+# Gallery rows scored per block in batched comparisons. 4096 float32 features are 2 MB, about an L2 cache.
+GALLERY_TILE_ROWS = 4096
 
 
-def retrieve_face_feature(blob):
+def _detector_upsample_times(image_shape) -> int:
     """
-    Retrieve face features from a blob. If there's no face in the image, return none.
+    Decide how many times the face detector upsamples an image. Each upsampling doubles
+    both sides (4x the pixels to scan), which only pays off to find small faces in small images.
+    :param image_shape: Shape of the image to detect faces in.
+    :return: Number of upsampling, 0 for images with a short side of 480 or above,
+             1 from 240, and 2 for smaller ones.
+    """
+    short_side = min(image_shape[:2])
+    if short_side >= 480:
+        return 0
+    if short_side >= 240:
+        return 1
+    return 2
+
+
+def retrieve_face_feature(file_data: bytes):
+    """
+    Retrieve face features from an image file. If there's no face in the image, return none.
     Each face is represented by a feature of a length-128 vector.
-    :param blob: Blob, base64 of an image.
+    :param file_data: Raw bytes of an image file, i.e., the base64-decoded blob.
     :return: The face feature of the first discovered face in the image,
              if this image contains any faces. Otherwise, None.
     """
 
-    # Retrieve image file from base64.
-    file_data = base64.b64decode(blob)
-    _image = Image.open(BytesIO(file_data))
+    models = _get_thread_models()
+
+    # Decode image file straight into a BGR array.
+    image = cv2.imdecode(np.frombuffer(file_data, dtype=np.uint8), cv2.IMREAD_COLOR)
+
+    if image is None:
+        raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST,
+                            detail=f"Decode image error: Unable to decode.")
 
-    # Convert to dlib-readable format.
-    image = np.array(_image)
-    image = cv2.cvtColor(image, cv2.COLOR_RGB2BGR)
     image_gray = cv2.cvtColor(image, cv2.COLOR_BGR2GRAY)
 
     # Adaptive Histogram Equalization: Detect performance under low resolution.
-    image_gray = cv2.createCLAHE(clipLimit=2.0, tileGridSize=(8, 8)).apply(image_gray)
+    image_gray = models.clahe.apply(image_gray)
 
-    # Retrieve faces
-    faces = face_detector(image_gray, upsample_num_times=2)
+    # Retrieve faces on a downscaled copy, since the detector's cost grows with the pixel count.
+    scale = min(1.0, DETECT_MAX_SIDE / max(image_gray.shape))
+    detect_gray = image_gray if scale == 1.0 else cv2.resize(image_gray, None, fx=scale, fy=scale,
+                                                             interpolation=cv2.INTER_AREA)
+    faces = _detect_faces(models, detect_gray, _detector_upsample_times(detect_gray.shape))
 
     if len(faces) == 0:
         return None
 
-    # Use the most significant face.
+    # Use the most significant face, mapped back onto the full-resolution image.
     face = faces[0]
+    face = dlib.rectangle(round(face.left() / scale), round(face.top() / scale),
+                          round(face.right() / scale), round(face.bottom() / scale))
 
     # Face landmarks.
     landmarks = predictor(image_gray, face)
-    face_feature = face_rec_model.compute_face_descriptor(image, landmarks)
+
+    # dlib's recognition model expects RGB. Only the aligned 150x150 face chip it reads is
+    # flipped from BGR, rather than converting the whole image.
+    face_chip = dlib.get_face_chip(image, landmarks)
+    face_feature = models.face_rec_model.compute_face_descriptor(np.ascontiguousarray(face_chip[:, :, ::-1]))
 
     return list(face_feature)
 
 
-def compare_faces(feature_1, feature_2) -> float:
+def _warm_up_thread_models(barrier: threading.Barrier):
+    """
+    Create the models of the current thread and run each of them once on a blank image,
+    so their weights are paged in and their buffers allocated before the first request.
+    :param barrier: Barrier shared by the warm-up of every pool thread.
+    """
+    # Wait for the other warm-ups, so that each one runs on a different thread of the pool.
+    barrier.wait()
+
+    models = _get_thread_models()
+    blank_gray = models.clahe.apply(np.zeros((DETECT_MAX_SIDE, DETECT_MAX_SIDE), dtype=np.uint8))
+    _detect_faces(models, blank_gray, 0)
+    predictor(blank_gray, dlib.rectangle(0, 0, 150, 150))
+    models.face_rec_model.compute_face_descriptor(np.zeros((150, 150, 3), dtype=np.uint8))
+
+
+async def retrieve_face_feature_async(file_data: bytes):
     """
-    Calculate the inverse Euclidean distance of two face features,
-    each being a 128-dimensional vector. If the score of the two
-    faces is higher than 1.7 (Euclidean distance smaller than 0.6),
+    Same as retrieve_face_feature, but run on the CPU pool, so the event loop
+    keeps serving other requests meanwhile.
+    :param file_data: Raw bytes of an image file.
+    :return: The face feature of the first discovered face in the image,
+             if this image contains any faces. Otherwise, None.
+    """
+    return await asyncio.get_running_loop().run_in_executor(CPU_POOL, retrieve_face_feature, file_data)
+
+
+async def decode_image_async(blob: bytes) -> bytes:
+    """
+    Same as _check_file_type with the allowed image types, but run on the CPU pool, so decoding
+    a large blob doesn't hold up the event loop.
+    :param blob: The base64 string of an image file.
+    :return: The decoded file bytes if file type is valid. Otherwise, an exception will be raised.
+    """
+    return await asyncio.get_running_loop().run_in_executor(CPU_POOL, _check_file_type, blob, ALLOWED_EXTENSIONS)
+
+
+def score_gallery(face_feature, gallery_matrix: np.ndarray, gallery_sq_norms: np.ndarray) -> np.ndarray:
+    """
+    Score a face feature against every feature of a gallery at once.
+    The score is the inverse Euclidean distance of two 128-dimensional features.
+    If it is higher than 1.7 (Euclidean distance smaller than 0.6),
     we can roughly decide that it is the same person.
 
     Source: https://dlib.net/face_recognition.py.html
 
-    :param feature_1: First feature.
-    :param feature_2: Second feature.
-    :return: The inverse Euclidean distance as a similarity score.
+    Since ||f - q||^2 = ||f||^2 + ||q||^2 - 2 f.q, the only per-query work
+    is one matrix-vector product over the gallery.
+
+    :param face_feature: The query face feature.
+    :param gallery_matrix: Gallery features, a (N, 128) float32 matrix.
+    :param gallery_sq_norms: Squared L2 norm of each gallery row, shape (N,).
+    :return: The similarity score of each gallery row, shape (N,).
+    """
+    q = np.asarray(face_feature, dtype=np.float32)
+    sq_dists = gallery_sq_norms + q @ q - 2.0 * (gallery_matrix @ q)
+    return 1.0 / (np.sqrt(np.maximum(sq_dists, 0.0)) + np.finfo(np.float32).eps)
+
+
+def score_gallery_batch(face_features, gallery_matrix: np.ndarray, gallery_sq_norms: np.ndarray,
+                        tile_rows: int = GALLERY_TILE_ROWS) -> np.ndarray:
     """
-    f1, f2 = np.array(feature_1), np.array(feature_2)
-    score = 1 / (np.linalg.norm(f1 - f2) + np.finfo(np.float32).eps)
-    return float(score)
+    Score several face features against every feature of a gallery at once.
+    Same scores as score_gallery, but the gallery is walked once for all queries:
+    each cache-sized block of rows is multiplied with every query in one matrix product.
+
+    :param face_features: The query face features, M of them.
+    :param gallery_matrix: Gallery features, a (N, 128) float32 matrix.
+    :param gallery_sq_norms: Squared L2 norm of each gallery row, shape (N,).
+    :param tile_rows: Number of gallery rows scored per block.
+    :return: The similarity scores, shape (M, N): row j holds the scores of query j.
+    """
+    q = np.asarray(face_features, dtype=np.float32).reshape(-1, FEATURE_DIM)
+    q_sq_norms = np.einsum("ij,ij->i", q, q)
+
+    scores = np.empty((len(q), len(gallery_matrix)), dtype=np.float32)
+    for start in range(0, len(gallery_matrix), tile_rows):
+        tile = slice(start, start + tile_rows)
+        sq_dists = q_sq_norms[:, None] + gallery_sq_norms[tile] - 2.0 * (q @ gallery_matrix[tile].T)
+        scores[:, tile] = 1.0 / (np.sqrt(np.maximum(sq_dists, 0.0)) + np.finfo(np.float32).eps)
+
+    return scores
+
+
+def rank_top_k(scores: np.ndarray, top_k: Optional[int] = None) -> np.ndarray:
+    """
+    Get the indices of the best scores, from highest to lowest.
+    Only the top k are sorted, after an O(N) partition of all scores.
+    :param scores: Scores to rank.
+    :param top_k: Number of best scores to return. All scores if None.
+    :return: Indices of the top k scores, sorted by descending score.
+    """
+    if top_k is None or top_k >= len(scores):
+        return np.argsort(-scores)
+
+    top_idx = np.argpartition(-scores, top_k - 1)[:top_k]
+    return top_idx[np.argsort(-scores[top_idx])]
+
+
+@router.on_event("startup")
+async def warm_models():
+    """
+    Warm up the models of every CPU pool thread when the server starts, so the first
+    requests don't pay for loading them.
+    """
+    loop = asyncio.get_running_loop()
+    barrier = threading.Barrier(CPU_WORKERS)
+    await asyncio.gather(*[loop.run_in_executor(CPU_POOL, _warm_up_thread_models, barrier)
+                           for _ in range(CPU_WORKERS)])
+
+
+@router.on_event("startup")
+def warm_gallery():
+    """
+    Fill the gallery when the server starts. From then on, writes keep it up to date.
+    """
+    db = SessionLocal()
+    try:
+        gallery.load(db)
+    finally:
+        db.close()
 
 
 def _check_file_type(blob: bytes, allowed_types):
@@ -107,22 +317,66 @@ def _check_file_type(blob: bytes, allowed_types):
     Check for file types from the blob.
     :param blob: The base64 string of the target file.
     :param allowed_types: A list of allowed types.
-    :return: True if file type is valid. Otherwise, an exception will be raised.
+    :return: The decoded file bytes if file type is valid. Otherwise, an exception will be raised.
     """
+    # 16 base64 characters are the first 12 bytes, enough for every file signature.
+    # Checking them first rejects unsupported files without decoding the whole blob.
+    # Whitespace and line breaks are legal in the blob, so they are dropped before counting.
+    head = b"".join(blob[:64].split())[:16]
+    if len(head) == 16:
+        try:
+            header = base64.b64decode(head)
+        except Exception as e:
+            raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST,
+                                detail=f"Decode base64 data error: Unable to decode.")
+
+        _check_file_signature(file_data=header, allowed_types=allowed_types)
+
     try:
         file_data = base64.b64decode(blob)
     except Exception as e:
         raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST,
                             detail=f"Decode base64 data error: Unable to decode.")
 
-    mime_type = magic.from_buffer(file_data, mime=True)
-    file_ext = mime_type.split("/")[-1]
+    # Too short or too sparse for the early check, so the signature is checked on the decoded file.
+    if len(head) < 16:
+        _check_file_signature(file_data=file_data, allowed_types=allowed_types)
+
+    return file_data
+
+
+def _check_file_signature(file_data: bytes, allowed_types):
+    """
+    Check for file types from the raw file bytes.
+    :param file_data: The raw bytes of the target file.
+    :param allowed_types: A list of allowed types.
+    :return: The file bytes if file type is valid. Otherwise, an exception will be raised.
+    """
+    # The supported formats are identified by their first few bytes alone.
+    file_ext = next((ext for signature, ext in FILE_SIGNATURES.items() if file_data.startswith(signature)),
+                    "unknown")
 
     if file_ext not in allowed_types:
         raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST,
                             detail=f"Unsupported file type: {file_ext}.")
 
-    return True
+    return file_data
+
+
+def _serialize_face(db_face: Face) -> dict:
+    """
+    Convert a face row to a JSON-friendly dict.
+    :param db_face: The face ORM object.
+    :return: The face as a dict, with its binary feature expanded to a list of floats.
+    """
+    return {
+        "id": db_face.id,
+        "uploaded_at": db_face.uploaded_at,
+        "uploaded_by": db_face.uploaded_by,
+        "blob": db_face.blob,
+        "feature": np.frombuffer(db_face.feature, dtype=np.float32).tolist(),
+        "description": db_face.description,
+    }
 
 
 @router.post("/upload_face/")
@@ -138,37 +392,124 @@ async def upload_face(
     :return: Upload message.
     """
 
-    _guard_db(auth=face_upload, token=token, permission=WRITE, db=db)
+    await run_in_threadpool(_guard_db, auth=face_upload, token=token, permission=WRITE, db=db)
+
+    file_data = await decode_image_async(face_upload.blob)
+
+    return await _save_face(user_id=face_upload.user_id,
+                      file_data=file_data,
+                      blob=face_upload.blob,
+                      description=face_upload.description,
+                      db=db)
+
+
+@router.post("/upload_face_file/")
+async def upload_face_file(
+        file: UploadFile = File(...),
+        user_id: UUID = Form(...),
+        description: Optional[str] = Form(None),
+        token: str = Depends(get_header_token),
+        db: Session = Depends(get_db)):
+    """
+    Upload a face as a multipart/form-data image file. Same as upload_face, but the image
+    is sent as raw bytes instead of base64 in JSON, which is a third smaller on the wire.
+    :param file: The image file.
+    :param user_id: The uploader's user id.
+    :param description: Description of the face.
+    :param token: Authorization JWT token.
+    :param db: Database session.
+    :return: Upload message.
+    """
+
+    await run_in_threadpool(_guard_db, auth=WithUserId(user_id=user_id), token=token, permission=WRITE, db=db)
+
+    file_data = _check_file_signature(file_data=await _read_upload_file(file), allowed_types=ALLOWED_EXTENSIONS)
+
+    # Faces are stored as base64, the same as the ones uploaded with upload_face.
+    return await _save_face(user_id=user_id,
+                      file_data=file_data,
+                      blob=base64.b64encode(file_data),
+                      description=description,
+                      db=db)
 
-    _check_file_type(blob=face_upload.blob, allowed_types=ALLOWED_EXTENSIONS)
 
-    face_feature = retrieve_face_feature(face_upload.blob)
+def _insert_face(db: Session, user_id: UUID, blob: bytes, description: Optional[str], face_feature):
+    """
+    Insert and commit a new face. The async routes that save faces run this on the threadpool,
+    since the Session blocks.
+    :param db: Database session.
+    :param user_id: The uploader's user id.
+    :param blob: Base64 of the image file.
+    :param description: Description of the face.
+    :param face_feature: Feature of the face.
+    :return: The id and upload time of the new face.
+    """
+    # The generated id and upload time come back with the INSERT, instead of a refresh after the commit.
+    new_face = db.execute(
+        insert(Face)
+        .values(uploaded_by=user_id,
+                blob=blob,
+                description=description,
+                feature=np.asarray(face_feature, dtype=np.float32).tobytes())
+        .returning(Face.id, Face.uploaded_at)
+    ).one()
+    db.commit()
+    return new_face
+
+
+async def _read_upload_file(file: UploadFile) -> bytes:
+    """
+    Read an uploaded file, a chunk at a time, up to MAX_FILE_BYTES.
+    :param file: The uploaded file.
+    :return: The file bytes. If the file is larger than MAX_FILE_BYTES, 413 will be raised.
+    """
+    too_large = HTTPException(status_code=status.HTTP_413_REQUEST_ENTITY_TOO_LARGE,
+                              detail=f"Image file too large: At most {MAX_FILE_BYTES} bytes are accepted.")
+
+    # The size is known up front for most multipart uploads.
+    if file.size is not None and file.size > MAX_FILE_BYTES:
+        raise too_large
+
+    chunks, num_bytes = [], 0
+    while chunk := await file.read(UPLOAD_CHUNK_BYTES):
+        num_bytes += len(chunk)
+        if num_bytes > MAX_FILE_BYTES:
+            raise too_large
+        chunks.append(chunk)
+
+    return b"".join(chunks)
+
+
+async def _save_face(user_id: UUID, file_data: bytes, blob: bytes, description: Optional[str], db: Session):
+    """
+    Retrieve the face feature of an uploaded image and save the face.
+    :param user_id: The uploader's user id.
+    :param file_data: Raw bytes of the image file.
+    :param blob: Base64 of the image file, which is stored.
+    :param description: Description of the face.
+    :param db: Database session.
+    :return: Upload message.
+    """
+    face_feature = await retrieve_face_feature_async(file_data)
 
     if face_feature is None:
         raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST,
                             detail=f"No face detected, therefore the image is not saved.")
 
-    new_face = Face(
-        uploaded_by=face_upload.user_id,
-        blob=face_upload.blob,
-        description=face_upload.description,
-        feature=face_feature
-    )
+    new_face = await run_in_threadpool(_insert_face, db, user_id, blob, description, face_feature)
 
-    db.add(new_face)
-    db.commit()
-    db.refresh(new_face)
+    gallery.append(new_face.id, description, face_feature)
 
     return {
         "face_id": new_face.id,
         "uploaded_at": new_face.uploaded_at,
-        "uploaded_by": new_face.uploaded_by,
-        "description": new_face.description,
+        "uploaded_by": user_id,
+        "description": description,
     }
 
 
 @router.post("/get_faces/")
-async def get_faces(
+def get_faces(
         faces_get: FacesGet,
         token: str = Depends(get_header_token),
         db: Session = Depends(get_db)):
@@ -188,19 +529,42 @@ async def get_faces(
                             detail="Invalid range. The \"to\" should be greater than the \"from\".")
     _offset = faces_get.range_from
 
-    total_num = db.query(Face).count()
+    # The gallery holds every face, so the total doesn't need a COUNT(*) over the table.
+    total_num = gallery.size()
 
-    db_faces = db.query(Face).order_by(desc(Face.uploaded_at)).offset(_offset).limit(_limit).all()
+    if (faces_get.last_uploaded_at is None) != (faces_get.last_face_id is None):
+        raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST,
+                            detail="Invalid cursor. Give both last_uploaded_at and last_face_id, or neither.")
+
+    stmt = select(Face).options(undefer(Face.blob)).order_by(desc(Face.uploaded_at), desc(Face.id))
+    if faces_get.last_uploaded_at is not None:
+        # Continue right after the previous page using the (uploaded_at, id) index, instead of
+        # sorting and skipping every row before the offset. The id keeps faces uploaded at the
+        # same time from being skipped at a page boundary. The cursor values are typed like
+        # their columns, or uploaded_at would lose its time zone.
+        stmt = stmt.where(
+            tuple_(Face.uploaded_at, Face.id) < tuple_(literal(faces_get.last_uploaded_at, Face.uploaded_at.type),
+                                                       literal(faces_get.last_face_id, Face.id.type))
+        )
+    else:
+        stmt = stmt.offset(_offset)
+
+    db_faces = db.execute(stmt.limit(_limit)).scalars().all()
 
     return {
         "num_total": total_num,
         "num_this_page": len(db_faces),   # In case limit is over total data num.
-        "faces": db_faces
+        # Pass as last_uploaded_at and last_face_id to get the next page.
+        "next_cursor": {
+            "last_uploaded_at": db_faces[-1].uploaded_at,
+            "last_face_id": db_faces[-1].id,
+        } if db_faces else None,
+        "faces": [_serialize_face(db_face) for db_face in db_faces]
     }
 
 
 @router.post("/update_face/")
-async def update_face(
+def update_face(
         face_update: FaceUpdate,
         token: str = Depends(get_header_token),
         db: Session = Depends(get_db)):
@@ -213,13 +577,21 @@ async def update_face(
     """
     _guard_db(auth=face_update, token=token, permission=READ, db=db)
 
-    face_to_update = find_by(orm=Face, attr="id", val=face_update.face_id,
-                             fail_detail=f"Update failed: No face with id {face_update.face_id} found.",
-                             db=db)
+    # One UPDATE, instead of loading the face, writing it back and refreshing it.
+    updated_face_id = db.execute(
+        update(Face)
+        .where(Face.id == face_update.face_id)
+        .values(description=face_update.description)
+        .returning(Face.id)
+    ).scalar()
+
+    if updated_face_id is None:
+        raise HTTPException(status_code=status.HTTP_404_NOT_FOUND,
+                            detail=f"Update failed: No face with id {face_update.face_id} found.")
 
-    face_to_update.description = face_update.description
     db.commit()
-    db.refresh(face_to_update)
+
+    gallery.update_description(updated_face_id, face_update.description)
 
     return {
         "msg": f"Face with id {face_update.face_id} has been updated successfully.",
@@ -228,7 +600,7 @@ async def update_face(
 
 
 @router.post("/delete_face/")
-async def delete_face(
+def delete_face(
         face_delete: FaceDelete,
         token: str = Depends(get_header_token),
         db: Session = Depends(get_db)):
@@ -241,18 +613,16 @@ async def delete_face(
     """
     _guard_db(auth=face_delete, token=token, permission=DELETE, db=db)
 
-    db_face = db.query(Face).filter(
-        cast("ColumnElement[bool]", Face.id == face_delete.face_id)
-        ).first()
-
-    if db_face is None:
-        raise HTTPException(status_code=status.HTTP_404_NOT_FOUND,
-                            detail=f"The face with id {face_delete.face_id} does not exist."
-                                   f"It is possible that the face has already been deleted.")
+    db_face = find_by_pk(orm=Face, pk=face_delete.face_id,
+                         fail_detail=f"The face with id {face_delete.face_id} does not exist."
+                                     f"It is possible that the face has already been deleted.",
+                         db=db)
 
     db.delete(db_face)
     db.commit()
 
+    gallery.remove(face_delete.face_id)
+
     return {"msg": f"Face with ID {face_delete.face_id} has been deleted."}
 
 
@@ -268,11 +638,15 @@ async def compare_face(
     :param db: Database session.
     :return: A list of matched faces' descriptions with scores.
     """
-    _guard_db(auth=face_compare, token=token, permission=DELETE, db=db)
+    await run_in_threadpool(_guard_db, auth=face_compare, token=token, permission=DELETE, db=db)
+
+    if face_compare.top_k is not None and face_compare.top_k < 1:
+        raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST,
+                            detail="Invalid top_k. It should be at least 1.")
 
-    _check_file_type(blob=face_compare.blob, allowed_types=ALLOWED_EXTENSIONS)
+    file_data = await decode_image_async(face_compare.blob)
 
-    face_feature = retrieve_face_feature(face_compare.blob)
+    face_feature = await retrieve_face_feature_async(file_data)
 
     if face_feature is None:
         raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST,
@@ -280,20 +654,64 @@ async def compare_face(
 
     _t_start = time.time()
 
-    global cached_faces
-    if len(cached_faces) == 0 or time.time() - cache_settle_time > CACHE_TTL:
-        db_faces = db.query(Face).all()
-        cached_faces = [(db_face.description, db_face.feature) for db_face in db_faces]
-
-    # desc_scores = [(cached_feature[0], compare_faces(face_feature, cached_feature[1]))
-    #                for cached_feature in cached_faces]
+    descs, matrix, sq_norms = gallery.snapshot()
+    scores = score_gallery(face_feature, matrix, sq_norms)
 
     desc_scores = [{
-        "description": cached_face[0],
-        "score": compare_faces(face_feature, cached_face[1]),
-    } for cached_face in cached_faces]
+        "description": descs[i],
+        "score": float(scores[i]),
+    } for i in rank_top_k(scores, face_compare.top_k)]
+
+    _t_query = time.time() - _t_start
+
+    return {
+        "desc_scores": desc_scores,
+        "query_time": _t_query
+    }
+
+
+@router.post("/compare_faces_batch/")
+async def compare_faces_batch(
+        faces_compare: FacesCompareBatch,
+        token: str = Depends(get_header_token),
+        db: Session = Depends(get_db)):
+    """
+    Upload several faces and find the matches of each, in one pass over the gallery.
+    :param faces_compare: Face blobs to upload.
+    :param token: Authorization JWT token.
+    :param db: Database session.
+    :return: For each uploaded face, a list of matched faces' descriptions with scores.
+    """
+    await run_in_threadpool(_guard_db, auth=faces_compare, token=token, permission=DELETE, db=db)
+
+    if faces_compare.top_k is not None and faces_compare.top_k < 1:
+        raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST,
+                            detail="Invalid top_k. It should be at least 1.")
+
+    if sum(len(blob) for blob in faces_compare.blobs) > MAX_BATCH_BLOB_LENGTH:
+        raise HTTPException(status_code=status.HTTP_413_REQUEST_ENTITY_TOO_LARGE,
+                            detail=f"Images too large: At most {MAX_BATCH_BLOB_LENGTH} base64 characters "
+                                   f"are accepted per batch.")
+
+    files_data = await asyncio.gather(*[decode_image_async(blob) for blob in faces_compare.blobs])
+
+    # The images are independent, so their features are retrieved in parallel.
+    face_features = await asyncio.gather(*[retrieve_face_feature_async(file_data) for file_data in files_data])
+
+    for i, face_feature in enumerate(face_features):
+        if face_feature is None:
+            raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST,
+                                detail=f"No face detected in image {i}, therefore the images can't be compared.")
+
+    _t_start = time.time()
+
+    descs, matrix, sq_norms = gallery.snapshot()
+    scores = score_gallery_batch(face_features, matrix, sq_norms)
 
-    desc_scores = sorted(desc_scores, key=lambda obj: obj["score"], reverse=True)
+    desc_scores = [[{
+        "description": descs[i],
+        "score": float(query_scores[i]),
+    } for i in rank_top_k(query_scores, faces_compare.top_k)] for query_scores in scores]
 
     _t_query = time.time() - _t_start
 
@@ -304,7 +722,7 @@ async def compare_face(
 
 
 @router.post("/find_faces/")
-async def find_faces(
+def find_faces(
         face_find: FacesFindByDesc,
         token: str = Depends(get_header_token),
         db: Session = Depends(get_db)):
@@ -317,14 +735,14 @@ async def find_faces(
     """
     _guard_db(auth=face_find, token=token, permission=READ, db=db)
 
-    db_faces = db.query(Face).filter(
+    db_faces = db.execute(select(Face).options(undefer(Face.blob)).where(
         Face.description.ilike(f"%{face_find.query}%")
-    ).all()
+    )).scalars().all()
 
     if not db_faces:
         raise HTTPException(status_code=status.HTTP_404_NOT_FOUND,
                             detail="No result for this query.")
 
     return {
-        "faces": db_faces
+        "faces": [_serialize_face(db_face) for db_face in db_faces]
     }
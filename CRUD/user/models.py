@@ -1,10 +1,10 @@
 # Packages
-from sqlalchemy import Column, String, Boolean, DateTime, func, SmallInteger
+from sqlalchemy import Column, String, Boolean, DateTime, Index, func, SmallInteger
 from sqlalchemy.dialects.postgresql import UUID
 from sqlalchemy.sql import text
 
 # Root reference
-from database import Base
+from database import Base, uuid7
 
 
 """
@@ -28,14 +28,18 @@ RESERVE_2 = 1 << 5
 DELETE_USERS = 1 << 6
 GRANT_PERMISSION = 1 << 7
 
+# Permissions that can be granted or revoked, one at a time.
+_VALID_PERMS = frozenset({READ, WRITE, DELETE, UPDATE, RESERVE_1, RESERVE_2, DELETE_USERS, GRANT_PERMISSION})
+
 
 class User(Base):
     """
     User model representing a user in the system.
 
     Attributes:
-        id (UUID): Auto-generated UUID for the user.
+        id (UUID): Auto-generated, time-ordered UUID for the user.
         created_at (DateTime): Timestamp of when the user was registered, with timezone information.
+        updated_at (DateTime): Timestamp of the last change to the user, with timezone information.
         email (String): Unique email address of the user.
         password_hash (String): Hashed password of the user.
         name (String): Username or nickname of the user.
@@ -44,23 +48,41 @@ class User(Base):
     """
 
     __tablename__ = "users"
+    __table_args__ = (
+        # Trigram index, so that find_users' ILIKE '%...%' doesn't scan every name.
+        # Needs the pg_trgm extension.
+        Index("users_name_trgm_idx", "name",
+              postgresql_using="gin",
+              postgresql_ops={"name": "gin_trgm_ops"}),
+        # Emails are unique regardless of case. Register and login look them up by lower(email).
+        Index("users_email_lower_key", text("lower(email)"), unique=True),
+        # Order of get_users' pages. The id breaks ties between users created at the same time.
+        Index("users_created_at_id_idx", text("created_at DESC"), text("id DESC")),
+    )
 
     # Auto-generated Fields
     id = Column(UUID(as_uuid=True),
                 primary_key=True,
-                default=text("uuid_generate_v4()"),
+                default=uuid7,     # Made here, so the INSERT carries its id.
                 server_default=text("uuid_generate_v4()"),
                 index=True)
 
     created_at = Column(DateTime(timezone=True),
                         default=func.now(),
                         server_default=func.now(),
+                        nullable=False)     # Indexed with id, see __table_args__.
+
+    # Set on every UPDATE issued through SQLAlchemy, ORM or Core alike.
+    updated_at = Column(DateTime(timezone=True),
+                        default=func.now(),
+                        server_default=func.now(),
+                        onupdate=func.now(),
                         nullable=False)
 
     # Manually-written Fields
-    email = Column(String, unique=True, index=True)
+    email = Column(String)     # Unique and indexed by lower(email), see __table_args__.
     password_hash = Column(String)
-    name = Column(String)
+    name = Column(String, index=True)     # Login by name looks it up by equality.
 
     # Verification Fields
     is_verified = Column(Boolean, default=False)
@@ -83,46 +105,6 @@ class User(Base):
         """
         self.password_hash = new_password_hash
 
-    def check_permission(self, permission: int) -> bool:
-        """
-        Check if the user have a specific permission.
-        :param permission: Permission bit code.
-        :return: True if the user has the permission, else false.
-        """
-        if permission < 0 or permission > 255:
-            raise ValueError("Invalid Permission: Permission code must be between 0 and 7.")
-        return self.permissions & permission != 0
-
-    def grant_permission(self, permission: int) -> int:
-        """
-        Grant permission to this user.
-        :param permission: Permission to be granted.
-        :return: The permission status after granting.
-        """
-        if permission < 0 or permission > 255:
-            raise ValueError("Invalid Permission: Permission code must be between 0 and 7.")
-
-        if permission & (permission - 1) != 0:
-            raise ValueError("Multiple Permission: Can only grant one permission at a time.")
-
-        self.permissions |= permission
-        return self.permissions
-
-    def revoke_permission(self, permission: int) -> int:
-        """
-        Revoke permission of this uer.
-        :param permission: Permission to be revoked.
-        :return: The permission status after revoking.
-        """
-        if permission < 0 or permission > 255:
-            raise ValueError("Invalid Permission: Permission code must be between 0 and 7.")
-
-        if permission & (permission - 1) != 0:
-            raise ValueError("Multiple Permission: Can only grant one permission at a time.")
-
-        self.permissions &= ~permission
-        return self.permissions
-
 
 '''
 def check_permission(user_permission: int, permission: int) -> bool:
@@ -1,6 +1,11 @@
-from pydantic import BaseModel
+from pydantic import BaseModel, Discriminator, Tag, Field
+from typing import Optional, Union, Annotated, List
+from datetime import datetime
 import uuid
 
+# Most users fetched in one batch.
+MAX_BATCH_USERS = 100
+
 
 class UserRegister(BaseModel):
     email: str
@@ -18,6 +23,25 @@ class UserLoginWithName(BaseModel):
     password: str
 
 
+def _login_kind(login) -> str:
+    """
+    Tell which way a user logs in, from the raw request body or a parsed login.
+    :param login: The login data.
+    :return: "email" if it logs in with email, otherwise "name".
+    """
+    if isinstance(login, dict):
+        return "email" if "email" in login else "name"
+    return "email" if isinstance(login, UserLoginWithEmail) else "name"
+
+
+# Login with either email or name. The body is validated against the matching schema only,
+# instead of trying each schema of the union in turn.
+UserLogin = Annotated[
+    Union[Annotated[UserLoginWithEmail, Tag("email")], Annotated[UserLoginWithName, Tag("name")]],
+    Discriminator(_login_kind)
+]
+
+
 class WithUserId(BaseModel):
     user_id: uuid.UUID
 
@@ -40,12 +64,19 @@ class PermissionEdit(WithUserId):
 class UsersGet(WithUserId):
     range_from: int
     range_to: int
+    # Cursor of the previous page: created_at and id of its last user, given together.
+    last_created_at: Optional[datetime] = None
+    last_user_id: Optional[uuid.UUID] = None
 
 
 class UsersFindByName(WithUserId):
     query: str
 
 
+class UsersGetByIds(WithUserId):
+    user_ids: Annotated[List[uuid.UUID], Field(max_length=MAX_BATCH_USERS)]
+
+
 class PasswordChange(WithUserId):
     requester_user_id: uuid.UUID
     new_password: str
@@ -1,32 +1,85 @@
 # FastAPI server essentials
-from typing import Union, cast
-from fastapi import APIRouter, Depends, HTTPException, status
+from typing import Optional
+from fastapi import APIRouter, Depends, HTTPException, status, Header, Response
+from fastapi.concurrency import run_in_threadpool
+from fastapi.responses import ORJSONResponse
 import uuid
 
 # PostgreSQL database connection
-from sqlalchemy import desc
+from sqlalchemy import desc, func, select, update, bindparam, tuple_, literal
+from sqlalchemy.dialects.postgresql import insert as pg_insert
 from sqlalchemy.orm import Session
 
-# Information Security
-from passlib.context import CryptContext
-
 # Locals
-from auth import generate_jwt, validate_user
+from auth import (generate_jwt, is_password_hash,
+                  hash_password, verify_password, dummy_verify_password)
 from database import get_db
-from CRUD.user.models import User, READ, GRANT_PERMISSION
+from CRUD.user.models import User, READ, GRANT_PERMISSION, _VALID_PERMS
 from CRUD.user.schemas import (
-    WithUserId, UserRegister, UserLoginWithEmail, UserLoginWithName,
-    PermissionEdit, UsersGet, EmailVerifySuper, UsersFindByName, PasswordChange)
-from query import find_by, _guard_db, get_header_token
+    WithUserId, UserRegister, UserLogin, UserLoginWithEmail, UserLoginWithName,
+    PermissionEdit, UsersGet, EmailVerifySuper, UsersFindByName, UsersGetByIds, PasswordChange)
+from query import (_guard_db, _guard_db_with_subject, get_header_token, get_current_user,
+                   invalidate_permissions, rate_limit)
 
 router = APIRouter()
 
-pwd_context = CryptContext(schemes=["bcrypt"], deprecated="auto")
+# Registrations and logins allowed per client per minute. Each one costs a bcrypt hash,
+# so without a limit a few clients could keep every core busy.
+REGISTER_RATE_LIMIT = 5
+LOGIN_RATE_LIMIT = 10
+
+# Seconds a client may reuse its copy of get_user before asking again.
+GET_USER_MAX_AGE = 30
+
+# Columns of a user in batch_get_users, the same ones get_user returns.
+USER_BATCH_COLUMNS = (User.id, User.created_at, User.email, User.name, User.permissions)
+
+# Columns of a user in the lists of get_users and find_users.
+USER_LIST_COLUMNS = (User.id, User.created_at, User.email, User.name,
+                     User.permissions, User.password_hash, User.is_verified)
+
+# Exact number of users, for the pages that can't carry it as a window count.
+USER_COUNT_STATEMENT = select(func.count()).select_from(User)
+
+# Matched case-insensitively, with surrounding spaces ignored.
+RESTRICTED_USER_NAMES = frozenset({"admin", "root", "guest", "null", "nil", "undefined", "postgres", "localhost"})
 
-RESTRICTED_USER_NAMES = ["admin", "root", "guest", "null", "nil", "undefined", "postgres", "localhost"]
+
+@router.on_event("startup")
+async def warm_password_hashing():
+    """
+    Run one dummy verify when the server starts. The dummy hash is made on first use,
+    which would otherwise slow down the first failed login.
+    """
+    await dummy_verify_password()
 
 
-@router.post("/register/")
+# The async routes below await bcrypt, so they can't be plain def. Their Session calls block,
+# so each one goes through run_in_threadpool, like the def routes do, instead of stalling the event loop.
+def _insert_user(db: Session, email: str, password_hash: str, name: str) -> Optional[uuid.UUID]:
+    """
+    Insert and commit a new user, unless the email is taken. One atomic statement instead of
+    a lookup followed by an insert, so two registrations of the same email can't race.
+    :param db: Database session.
+    :param email: Email of the user.
+    :param password_hash: Hash of the user's password.
+    :param name: Name of the user.
+    :return: The id of the new user, or None if the email is already registered.
+    """
+    new_user_id = db.execute(
+        pg_insert(User)
+        .values(email=email, password_hash=password_hash, name=name)
+        .on_conflict_do_nothing(index_elements=[func.lower(User.email)])
+        .returning(User.id)
+    ).scalar()
+
+    if new_user_id is not None:
+        db.commit()
+
+    return new_user_id
+
+
+@router.post("/register/", dependencies=[Depends(rate_limit(times=REGISTER_RATE_LIMIT, seconds=60))])
 async def register_user(user_register: UserRegister,
                         db: Session = Depends(get_db)):
     """
@@ -35,40 +88,35 @@ async def register_user(user_register: UserRegister,
     :param db: Database object.
     :return: Registration result.
     """
-    db_user = db.query(User).filter(
-        cast("ColumnElement[bool]", User.email == user_register.email)
-    ).first()
+    # Stored without the surrounding spaces that slip in from a form field. Names aren't unique.
+    user_name = user_register.name.strip()
 
-    if db_user:
-        # User exists.
-        raise HTTPException(status_code=400, detail="Email already registered.")
-
-    if user_register.name in RESTRICTED_USER_NAMES:
+    if user_name.casefold() in RESTRICTED_USER_NAMES:
         # An easter egg.
         raise HTTPException(status_code=400, detail="You're smart, but this user name is invalid.")
 
     # Encrypt user password
-    hashed_password = pwd_context.hash(user_register.password)
+    hashed_password = await hash_password(user_register.password)
 
-    # Create new user
-    new_user = User(email=user_register.email, password_hash=hashed_password, name=user_register.name)
-    db.add(new_user)
-    db.commit()
-    db.refresh(new_user)
+    new_user_id = await run_in_threadpool(_insert_user, db, user_register.email, hashed_password, user_name)
+
+    if new_user_id is None:
+        # User exists.
+        raise HTTPException(status_code=400, detail="Email already registered.")
 
     # Generate JWT token for email confirmation
-    token = generate_jwt(new_user.id)
+    token = generate_jwt(new_user_id)
 
     return {
         "msg": "OK",
-        "user_id": str(new_user.id),
+        "user_id": str(new_user_id),
         "token": token,
         "detail": "User registered successfully. Please check your mailbox."
     }
 
 
 @router.post("/verify_email_super/")
-async def verify_email_super(
+def verify_email_super(
         email_verify_super: EmailVerifySuper,
         token: str = Depends(get_header_token),
         db=Depends(get_db)):
@@ -81,22 +129,48 @@ async def verify_email_super(
     """
     _guard_db(auth=email_verify_super, token=token, permission=GRANT_PERMISSION, db=db)
 
-    db_user = find_by(orm=User,
-                      attr="id",
-                      val=email_verify_super.verify_user_id,
-                      fail_detail=f"Can't verify user with id {email_verify_super}: "
-                                  f"User not found.",
-                      db=db)
+    # Flip the flag in one statement, instead of loading the user and writing it back.
+    verified_user_id = db.execute(
+        update(User)
+        .where(User.id == email_verify_super.verify_user_id)
+        .values(is_verified=True)
+        .returning(User.id)
+    ).scalar()
+
+    if verified_user_id is None:
+        raise HTTPException(status_code=status.HTTP_404_NOT_FOUND,
+                            detail=f"Can't verify user with id {email_verify_super.verify_user_id}: "
+                                   f"User not found.")
 
-    db_user.verify_email()
     db.commit()
 
     return {"msg": "Email verified by super user successfully."}
 
 
-@router.post("/login/")
+# Statement to find the user of each kind of login, and the login field bound into it. Built once,
+# so a login only binds its value instead of rebuilding the query. Only the columns a login needs.
+LOGIN_STATEMENTS = {
+    UserLoginWithEmail: (select(User.id, User.password_hash, User.is_verified)
+                         .where(func.lower(User.email) == func.lower(bindparam("email"))).limit(1), "email"),
+    UserLoginWithName: (select(User.id, User.password_hash, User.is_verified)
+                        .where(User.name == bindparam("name")).limit(1), "name"),
+}
+
+
+def _find_login_user(db: Session, stmt, params: dict):
+    """
+    Find the user of a login. Run on the threadpool by login_user.
+    :param db: Database session.
+    :param stmt: The login statement, from LOGIN_STATEMENTS.
+    :param params: The login field bound into the statement.
+    :return: The id, password hash and verification flag of the user, or None if there's no such user.
+    """
+    return db.execute(stmt, params).first()
+
+
+@router.post("/login/", dependencies=[Depends(rate_limit(times=LOGIN_RATE_LIMIT, seconds=60))])
 async def login_user(
-        user_login: Union[UserLoginWithEmail, UserLoginWithName],
+        user_login: UserLogin,
         db: Session = Depends(get_db)):
     """
     Login existing user.
@@ -105,20 +179,23 @@ async def login_user(
     :return: Login result.
     """
 
-    if isinstance(user_login, UserLoginWithEmail):
-        filter_condition = (User.email == user_login.email)
-    elif isinstance(user_login, UserLoginWithName):
-        filter_condition = (User.name == user_login.name)
-    else:
+    login_statement = LOGIN_STATEMENTS.get(type(user_login))
+    if login_statement is None:
         raise HTTPException(status_code=400, detail="(Dev) Invalid post parameters.")
 
-    db_user = db.query(User).filter(
-        cast("ColumnElement[bool]", filter_condition)
-    ).first()
+    stmt, field = login_statement
+    # Matched exactly as given. Names stored before register_user stripped them may still
+    # have surrounding spaces, and stripping here would lock those users out.
+    db_user = await run_in_threadpool(_find_login_user, db, stmt, {field: getattr(user_login, field)})
+
+    # No user, or a hash that isn't bcrypt, can't match. Still spend the time of a bcrypt verify,
+    # so the response time doesn't tell whether the account exists.
+    if not db_user or not is_password_hash(db_user.password_hash):
+        await dummy_verify_password()
+        raise HTTPException(status_code=400, detail="Incorrect username or password.")
 
     # Password validation failed.
-    if (not db_user or not isinstance(db_user, User) or
-            not pwd_context.verify(user_login.password, db_user.password_hash)):
+    if not await verify_password(user_login.password, db_user.password_hash):
         raise HTTPException(status_code=400, detail="Incorrect username or password.")
 
     # Email verification.
@@ -147,49 +224,32 @@ async def change_password(
     :param token: Authorization JWT token.
     :param db: Database object.
     """
-    validate_user(password_change.user_id, token)
-
-    _guard_db(auth=password_change, token=token, permission=GRANT_PERMISSION, db=db)
-
-    db_user = find_by(orm=User,
-                      attr="id",
-                      val=password_change.requester_user_id,
-                      db=db)
+    # The guard validates the token against user_id too, so there's no separate validate_user call.
+    db_user = await run_in_threadpool(_guard_db_with_subject, auth=password_change, token=token,
+                                      permission=GRANT_PERMISSION,
+                                      subject_id=password_change.requester_user_id,
+                                      db=db)
 
     if not db_user.is_verified:
         raise HTTPException(status_code=status.HTTP_403_FORBIDDEN, detail=f"User {db_user.id} is not verified.")
 
-    hashed_password = pwd_context.hash(password_change.new_password)
+    hashed_password = await hash_password(password_change.new_password)
 
     db_user.change_password(new_password_hash=hashed_password)
     db_user.verify_email(verify=False)
-    db.commit()
-    db.refresh(db_user)
+    await run_in_threadpool(db.commit)
 
     return {
         "msg": f"Successfully updated password for user {password_change.user_id}."
     }
 
 
-@router.post("/get_user/")
-async def get_user(
-        with_user_id: WithUserId,
-        token: str = Depends(get_header_token),
-        db: Session = Depends(get_db)):
+def _user_info(db_user: User) -> dict:
     """
-    Get information of a specific user.
-    :param with_user_id: User authentication schema.
-    :param token: Authorization JWT token.
-    :param db: Database object.
-    :return: The information of the user.
+    Get the information of a user that get_user returns.
+    :param db_user: The user.
+    :return: The information of the user, without the password hash.
     """
-    validate_user(with_user_id.user_id, token)
-
-    db_user = find_by(orm=User,
-                      attr="id",
-                      val=with_user_id.user_id,
-                      db=db)
-
     return {
         "user_id": str(db_user.id),
         "created_at": str(db_user.created_at),
@@ -199,8 +259,56 @@ async def get_user(
     }
 
 
+@router.post("/get_user/")
+def get_user(
+        with_user_id: WithUserId,
+        db_user: User = Depends(get_current_user)):
+    """
+    Get information of a specific user. POST responses aren't cached, see GET /get_user/ for the cacheable one.
+    :param with_user_id: User authentication schema.
+    :param db_user: The user of the authorization token.
+    :return: The information of the user.
+    """
+    if db_user.id != with_user_id.user_id:
+        raise HTTPException(status_code=status.HTTP_403_FORBIDDEN,
+                            detail=f"Authorization token can't be verified specifically for this user.")
+
+    return _user_info(db_user)
+
+
+@router.get("/get_user/")
+def get_current_user_info(
+        response: Response,
+        db_user: User = Depends(get_current_user),
+        if_none_match: Optional[str] = Header(None)):
+    """
+    Get information of the user of the authorization token. The response carries an ETag that
+    changes whenever the user does, so the browser revalidates its copy with If-None-Match and
+    gets 304 with no body while it's unchanged.
+    :param response: The response, to set the caching headers on.
+    :param db_user: The user of the authorization token.
+    :param if_none_match: ETags of the client's copies, if it has any.
+    :return: The information of the user.
+    """
+    etag = f'W/"{db_user.id}-{int(db_user.updated_at.timestamp() * 1_000_000)}"'
+    # Private: the response depends on the Authorization header, so shared caches mustn't keep it.
+    caching_headers = {"ETag": etag,
+                       "Cache-Control": f"private, max-age={GET_USER_MAX_AGE}",
+                       "Vary": "Authorization"}
+
+    # If-None-Match compares weakly, so the W/ prefix of either side is ignored.
+    if if_none_match is not None:
+        client_etags = {client_etag.strip().removeprefix("W/") for client_etag in if_none_match.split(",")}
+        if "*" in client_etags or etag.removeprefix("W/") in client_etags:
+            return Response(status_code=status.HTTP_304_NOT_MODIFIED, headers=caching_headers)
+
+    response.headers.update(caching_headers)
+
+    return _user_info(db_user)
+
+
 @router.post("/get_users/")
-async def get_users(
+def get_users(
         users_get: UsersGet,
         token: str = Depends(get_header_token),
         db: Session = Depends(get_db)):
@@ -222,15 +330,43 @@ async def get_users(
 
     _offset = users_get.range_from
 
-    total_num = db.query(User).count()
+    if (users_get.last_created_at is None) != (users_get.last_user_id is None):
+        raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST,
+                            detail="Invalid cursor. Give both last_created_at and last_user_id, or neither.")
 
-    db_users = db.query(User).order_by(desc(
-        cast("ColumnElement[_T]", User.created_at)
-    )).offset(_offset).limit(_limit).all()
+    if users_get.last_created_at is None:
+        # The total travels with the page as a window count, instead of a separate COUNT(*) query.
+        stmt = select(*USER_LIST_COLUMNS, func.count().over().label("total")).offset(_offset)
+    else:
+        # Continue right after the previous page using the (created_at, id) index, instead of
+        # skipping the offset rows. Users created in the same transaction share created_at,
+        # so the id keeps them from being skipped at a page boundary.
+        stmt = select(*USER_LIST_COLUMNS).where(
+            # The cursor values are typed like their columns, or created_at would lose its time zone.
+            tuple_(User.created_at, User.id) < tuple_(literal(users_get.last_created_at, User.created_at.type),
+                                                      literal(users_get.last_user_id, User.id.type))
+        )
+
+    # Plain rows of the listed columns. The page is read-only, so there's no need for ORM objects.
+    db_users = db.execute(stmt.order_by(desc(User.created_at), desc(User.id)).limit(_limit)).all()
+
+    if users_get.last_created_at is None and db_users:
+        total_num = db_users[0].total
+    else:
+        # A window past the cursor would only count the rows after it, and a page past the end
+        # has no row to carry the total, so then the users are counted on their own.
+        total_num = db.execute(USER_COUNT_STATEMENT).scalar()
 
-    return {
+    # The page is built from JSON-native values, so it goes straight to orjson,
+    # skipping FastAPI's per-value jsonable_encoder pass.
+    return ORJSONResponse({
         "num_total": total_num,
         "num_this_page": len(db_users),
+        # Pass as last_created_at and last_user_id to get the next page.
+        "next_cursor": {
+            "last_created_at": db_users[-1].created_at.isoformat(),
+            "last_user_id": str(db_users[-1].id),
+        } if db_users else None,
         "users": [{
                     "user_id": str(db_user.id),
                     "created_at": str(db_user.created_at),
@@ -240,11 +376,11 @@ async def get_users(
                     "password_hash": str(db_user.password_hash),
                     "is_verified": db_user.is_verified
                   } for db_user in db_users]
-    }
+    })
 
 
 @router.post("/find_users/")
-async def find_users(
+def find_users(
         users_find: UsersFindByName,
         token: str = Depends(get_header_token),
         db: Session = Depends(get_db)):
@@ -259,9 +395,14 @@ async def find_users(
 
     _guard_db(auth=users_find, token=token, permission=READ, db=db)
 
-    db_users = db.query(User).filter(User.name.ilike(f"%{users_find.query}%")).all()
+    stmt = select(*USER_LIST_COLUMNS)
+    # The empty query matches every name, so it doesn't need the LIKE at all.
+    if users_find.query:
+        stmt = stmt.where(User.name.ilike(f"%{users_find.query}%"))
 
-    return {
+    db_users = db.execute(stmt).all()
+
+    return ORJSONResponse({
         "users": [{
                     "user_id": str(db_user.id),
                     "created_at": str(db_user.created_at),
@@ -271,11 +412,46 @@ async def find_users(
                     "password_hash": str(db_user.password_hash),
                     "is_verified": db_user.is_verified
                   } for db_user in db_users]
-    }
+    })
+
+
+@router.post("/batch_get_users/")
+def batch_get_users(
+        users_get_by_ids: UsersGetByIds,
+        token: str = Depends(get_header_token),
+        db: Session = Depends(get_db)):
+    """
+    Get information of several users at once, instead of one get_user request per user.
+    The token is verified once and all users are read in a single query.
+    Emails and permissions of other users are returned, so it needs the admin permission, as get_users does.
+    :param users_get_by_ids: Users get by ids data.
+    :param token: Authorization JWT token.
+    :param db: Database session.
+    :return: The information of each found user, by user id. Ids that aren't found are left out.
+    """
+
+    _guard_db(auth=users_get_by_ids, token=token, permission=GRANT_PERMISSION, db=db)
+
+    if not users_get_by_ids.user_ids:
+        return ORJSONResponse({"users": {}})
+
+    db_users = db.execute(select(*USER_BATCH_COLUMNS).where(User.id.in_(users_get_by_ids.user_ids))).all()
+
+    return ORJSONResponse({
+        "users": {
+            str(db_user.id): {
+                "user_id": str(db_user.id),
+                "created_at": str(db_user.created_at),
+                "email": db_user.email,
+                "name": db_user.name,
+                "permissions": db_user.permissions
+            } for db_user in db_users
+        }
+    })
 
 
 @router.post("/edit_permission/")
-async def edit_permission(
+def edit_permission(
         permission_edit: PermissionEdit,
         token: str = Depends(get_header_token),
         db: Session = Depends(get_db)):
@@ -288,26 +464,35 @@ async def edit_permission(
     """
 
     '''
-    Operator
+    Operator & Permission Applier, fetched together
     '''
     # validate_user(permission_edit.operator_user_id, permission_edit.token)
     _guard_db(auth=permission_edit, token=token, permission=GRANT_PERMISSION, db=db)
 
-    '''
-    Permission Applier
-    '''
-    db_requester_user = find_by(orm=User,
-                                attr="id",
-                                val=permission_edit.requester_user_id,
-                                fail_detail=f"Requestor {permission_edit.requester_user_id} not found.",
-                                db=db)
+    if permission_edit.permission not in _VALID_PERMS:
+        raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST,
+                            detail="Invalid Permission: Can only grant or revoke one permission "
+                                   "of code 0 to 7 at a time.")
 
+    # Set or clear the bit in one statement, instead of loading the user and writing it back.
     if permission_edit.grant:
-        db_requester_user.grant_permission(permission_edit.permission)
+        new_permissions = User.permissions.op("|")(permission_edit.permission)
     else:
-        db_requester_user.revoke_permission(permission_edit.permission)
+        new_permissions = User.permissions.op("&")(~permission_edit.permission)
+
+    requester_user_id = db.execute(
+        update(User)
+        .where(User.id == permission_edit.requester_user_id)
+        .values(permissions=new_permissions)
+        .returning(User.id)
+    ).scalar()
+
+    if requester_user_id is None:
+        raise HTTPException(status_code=status.HTTP_404_NOT_FOUND,
+                            detail=f"Requestor {permission_edit.requester_user_id} not found.")
 
     db.commit()
+    invalidate_permissions(permission_edit.requester_user_id)
 
     return {
         "msg": "Grant permission successful.",
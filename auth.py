@@ -1,11 +1,17 @@
 # Basics
 import os
-import datetime
+import time
+import asyncio
+import hashlib
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from functools import lru_cache
 import uuid
 
 # Security
 import jwt
 import secrets
+import bcrypt
 from dotenv import load_dotenv
 
 # FastAPI tools
@@ -19,6 +25,39 @@ if not SECRET_KEY:
     raise ValueError("Missing critical environment variable: "
                      "Environment variable SECRET_KEY is not configured.")
 
+# Seconds a login token stays valid.
+JWT_LIFETIME = 30 * 24 * 60 * 60
+
+# Encoder and decoder reused for every token, with the HMAC key encoded once instead of on each call.
+_jwt = jwt.PyJWT()
+_jwt_key = SECRET_KEY.encode("utf-8")
+_jwt_algorithms = ["HS256"]
+
+# A token without an expiry or a user id is rejected while decoding.
+_jwt_decode_options = {"verify_signature": True, "require": ["exp", "user_id"]}
+
+# Seconds a verified token's payload is reused before its signature is checked again.
+JWT_CACHE_TTL = 60
+
+# Most tokens whose payloads are cached at once.
+JWT_CACHE_SIZE = 10_000
+
+# Token digest -> (payload, expiry time). Every authorized request verifies its token, often the same one.
+# Lookups are plain dict reads; the lock only keeps eviction and insertion from interleaving.
+_jwt_cache = {}
+_jwt_cache_lock = threading.Lock()
+
+# bcrypt cost factor: each hash takes 2^BCRYPT_ROUNDS rounds, about 0.2 s on a server core at 12.
+# Pinned so the login cost doesn't move with the library's default. Existing hashes keep their own cost.
+BCRYPT_ROUNDS = 12
+
+# bcrypt ignores everything past the first 72 bytes of a password.
+BCRYPT_MAX_PASSWORD_BYTES = 72
+
+# Hashing takes a core for a fraction of a second, and bcrypt releases the GIL meanwhile,
+# so it runs on this pool instead of blocking the event loop.
+BCRYPT_POOL = ThreadPoolExecutor(max_workers=os.cpu_count())
+
 credential_exception = HTTPException(status_code=status.HTTP_401_UNAUTHORIZED,
                                      detail="Could not validate authorization credentials.",
                                      headers={"WWW-Authenticate": "Bearer"}, )
@@ -37,9 +76,9 @@ def generate_jwt(user_id: uuid.UUID):
     """
     payload = {
         "user_id": str(user_id),
-        "exp": datetime.datetime.now() + datetime.timedelta(days=30)
+        "exp": int(time.time()) + JWT_LIFETIME
     }
-    token = jwt.encode(payload, SECRET_KEY, algorithm="HS256")
+    token = _jwt.encode(payload, _jwt_key, algorithm=_jwt_algorithms[0])
     return token
 
 
@@ -49,12 +88,29 @@ def verify_jwt(token):
     :param token: JWT token.
     :return: If JWT is valid, return payload. Otherwise, return None.
     """
+    now = time.time()
+    # Keyed by a short digest rather than the token itself, so the cache holds 16 bytes per token.
+    cache_key = hashlib.blake2b(token.encode() if isinstance(token, str) else token, digest_size=16).digest()
+    cached = _jwt_cache.get(cache_key)
+    if cached is not None and cached[1] > now:
+        return cached[0]
+
     try:
-        payload = jwt.decode(token, SECRET_KEY, algorithms=["HS256"])
-        return payload
+        payload = _jwt.decode(token, _jwt_key, algorithms=_jwt_algorithms, options=_jwt_decode_options)
     except (jwt.ExpiredSignatureError, jwt.InvalidTokenError):
         return None
 
+    with _jwt_cache_lock:
+        if len(_jwt_cache) >= JWT_CACHE_SIZE:
+            # Drop the expired entries, or the oldest one if none has expired.
+            for key in [key for key, (_, expiry) in _jwt_cache.items() if expiry <= now] or \
+                       [next(iter(_jwt_cache))]:
+                del _jwt_cache[key]
+
+        # Never reuse the payload past the token's own expiry.
+        _jwt_cache[cache_key] = (payload, min(now + JWT_CACHE_TTL, payload.get("exp", now)))
+    return payload
+
 
 def validate_user(
         user_id: uuid.UUID,
@@ -69,7 +125,8 @@ def validate_user(
     if not token:
         raise credential_exception
 
-    token = token.split(" ")[1] if " " in token else token
+    # Callers usually pass the bare token from get_header_token, but accept the whole header too.
+    token = token[7:] if token[:7] == "Bearer " else token
 
     # If the token expires or is invalid, exception will be raised here.
     payload = verify_jwt(token)
@@ -85,3 +142,86 @@ def validate_user(
                             detail=f"Authorization token can't be verified specifically for this user.")
 
     return True
+
+
+# Hash prefixes that the bcrypt package can check. Anything else can't be a password of this server.
+BCRYPT_IDENTS = (b"$2a$", b"$2b$", b"$2y$")
+
+# Length of a bcrypt hash: prefix, 2-digit cost, "$", 22 characters of salt and 31 of checksum.
+BCRYPT_HASH_LENGTH = 60
+
+
+@lru_cache(maxsize=1)
+def _dummy_hash() -> bytes:
+    """
+    Get a hash to verify against when there's no real one, made on first use.
+    :return: The bcrypt hash of an empty password at the pinned cost.
+    """
+    return bcrypt.hashpw(b"", bcrypt.gensalt(rounds=BCRYPT_ROUNDS))
+
+
+def is_password_hash(password_hash) -> bool:
+    """
+    Check that a stored value is a bcrypt hash that verify_password can check.
+    :param password_hash: The stored password hash, possibly None.
+    :return: True if it is a bcrypt hash, else false.
+    """
+    if not password_hash:
+        return False
+    password_hash = password_hash.encode("ascii", "replace")
+    return len(password_hash) == BCRYPT_HASH_LENGTH and password_hash[:4] in BCRYPT_IDENTS
+
+
+# The blocking bcrypt calls that hash_password, verify_password and dummy_verify_password run
+# on the bcrypt pool. The bcrypt package is called directly, with no scheme dispatch in between.
+def _hash(password: bytes) -> str:
+    return bcrypt.hashpw(password, bcrypt.gensalt(rounds=BCRYPT_ROUNDS)).decode("ascii")
+
+
+def _verify(password: bytes, password_hash: str) -> bool:
+    try:
+        return bcrypt.checkpw(password, password_hash.encode("ascii"))
+    except ValueError:
+        # A malformed salt or cost in the stored hash.
+        return False
+
+
+def _dummy_verify():
+    bcrypt.checkpw(b"", _dummy_hash())
+
+
+def _clamp_password(password: str) -> bytes:
+    """
+    Encode a password the way bcrypt reads it. bcrypt only uses the first 72 bytes,
+    so they are cut here instead of handing the whole input to the backend.
+    :param password: The plain password.
+    :return: At most the first 72 bytes of the UTF-8 password.
+    """
+    return password.encode("utf-8")[:BCRYPT_MAX_PASSWORD_BYTES]
+
+
+async def hash_password(password: str) -> str:
+    """
+    Hash a password on the bcrypt pool.
+    :param password: The plain password.
+    :return: The password hash.
+    """
+    return await asyncio.get_running_loop().run_in_executor(BCRYPT_POOL, _hash, _clamp_password(password))
+
+
+async def verify_password(password: str, password_hash: str) -> bool:
+    """
+    Verify a password against its hash on the bcrypt pool.
+    :param password: The plain password.
+    :param password_hash: The stored password hash.
+    :return: True if the password matches, else false.
+    """
+    return await asyncio.get_running_loop().run_in_executor(BCRYPT_POOL, _verify,
+                                                            _clamp_password(password), password_hash)
+
+
+async def dummy_verify_password():
+    """
+    Verify a password against a dummy hash on the bcrypt pool, taking as long as a real verify.
+    """
+    await asyncio.get_running_loop().run_in_executor(BCRYPT_POOL, _dummy_verify)
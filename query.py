@@ -1,53 +1,131 @@
+# Basic
+import time
+import uuid
+import threading
+from collections import deque
+
 # FastAPI server essentials
-from typing import cast, Optional
-from fastapi import Depends, HTTPException, status, Header
+from typing import Optional
+from fastapi import Depends, HTTPException, status, Header, Request
 
 # PostgreSQL database connection
+from sqlalchemy import select
 from sqlalchemy.orm import Session
 
 # Locals
-from auth import validate_user
+from auth import validate_user, verify_jwt, credential_exception
 from database import get_db
 from CRUD.user.models import User
 from CRUD.user.schemas import WithUserId
 from database import Base
 
+# Seconds a user's permissions are trusted before they are read from the database again.
+PERMISSION_CACHE_TTL = 60
 
-def find_by(orm: Base,
-            attr: str,
-            val,
-            fail_detail: Optional[str] = None,
-            db: Session = Depends(get_db)) -> Base:
-    """
-    Find an orm object by its attribute. Equivalent to:
+# Most users whose permissions are cached at once.
+PERMISSION_CACHE_SIZE = 10_000
+
+# User id -> (permissions, expiry time). Saves the user lookup on every authorized request.
+# Routes run on the threadpool, so the lock keeps eviction and insertion from interleaving.
+_permission_cache = {}
+_permission_cache_lock = threading.Lock()
 
-    ``SELECT * FROM <orm> WHERE <attr> = <val>;``
+# Most clients whose recent requests a rate limiter remembers before it forgets the idle ones.
+RATE_LIMIT_CLIENTS = 10_000
 
+
+def find_by_pk(orm: Base,
+               pk,
+               fail_detail: Optional[str] = None,
+               db: Session = Depends(get_db)) -> Base:
+    """
+    Find an orm object by its primary key. Equivalent to ``SELECT * FROM <orm> WHERE id = <pk>;``,
+    but goes through the session's identity map, so an object already loaded in this session costs no query.
     :param orm: ORM object to find.
-    :param attr: The column attribute, should be unique.
-    :param val: The match value of the attribute.
-    :param fail_detail: The error message to display when find user failed.
+    :param pk: The primary key value.
+    :param fail_detail: The error message to display when find failed.
     :param db: Database Session.
-    :return: The matched user. Otherwise, returns 404.
+    :return: The matched object. Otherwise, returns 404.
     """
+    db_orm = db.get(orm, pk)
 
-    # This orm object doesn't have this attribute.
-    column = getattr(orm, attr, None)
-    if column is None:
-        raise HTTPException(status_code=status.HTTP_500_INTERNAL_SERVER_ERROR,
-                            detail=f"Invalid attribute access of {attr}.")
+    if db_orm is None:
+        if fail_detail is None:
+            fail_detail = f"{orm.__name__} with id {str(pk)} is not found."
+        raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail=fail_detail)
 
-    db_orm = db.query(orm).filter(
-        cast("ColumnElement[bool]", column == val)
-    ).first()
+    return db_orm
 
-    if fail_detail is None:
-        fail_detail = f"{orm.__class__.__name__} with {attr} {str(val)} is not found."
 
-    if not db_orm:
-        raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail=fail_detail)
+def _cached_permissions(user_id) -> Optional[int]:
+    """
+    Get the cached permissions of a user.
+    :param user_id: The user id.
+    :return: The permission bits of the user, or None if they aren't cached or have expired.
+    """
+    cached = _permission_cache.get(user_id)
+    if cached is not None and cached[1] > time.monotonic():
+        return cached[0]
+    return None
 
-    return db_orm
+
+def _cache_permissions(user_id, permissions: int):
+    """
+    Cache the permissions of a user for PERMISSION_CACHE_TTL seconds.
+    :param user_id: The user id.
+    :param permissions: The permission bits of the user.
+    """
+    now = time.monotonic()
+    with _permission_cache_lock:
+        if len(_permission_cache) >= PERMISSION_CACHE_SIZE:
+            # Drop the expired entries, or the oldest one if none has expired.
+            for key in [key for key, (_, expiry) in _permission_cache.items() if expiry <= now] or \
+                       [next(iter(_permission_cache))]:
+                del _permission_cache[key]
+
+        _permission_cache[user_id] = (permissions, now + PERMISSION_CACHE_TTL)
+
+
+def invalidate_permissions(user_id):
+    """
+    Forget the cached permissions of a user, so that a change to them applies to the next request.
+    :param user_id: The user id.
+    """
+    with _permission_cache_lock:
+        _permission_cache.pop(user_id, None)
+
+
+def _get_permissions(user_id, db: Session) -> int:
+    """
+    Get the permissions of a user, from the cache if they are fresh enough.
+    :param user_id: The user id.
+    :param db: Database session.
+    :return: The permission bits of the user. If the user doesn't exist, 404 will be raised.
+    """
+    permissions = _cached_permissions(user_id)
+    if permissions is not None:
+        return permissions
+
+    db_user = find_by_pk(orm=User,
+                         pk=user_id,
+                         fail_detail=f"Failed to verify user {user_id}",
+                         db=db)
+
+    _cache_permissions(user_id, db_user.permissions)
+    return db_user.permissions
+
+
+def _check_permissions(user_id, permissions: int, permission: int):
+    """
+    Check that a user has a permission.
+    :param user_id: The user id.
+    :param permissions: The permission bits of the user.
+    :param permission: The target permission to check to allow this operation.
+    :return: None. If the user lacks the permission, 403 will be raised.
+    """
+    if permissions & permission == 0:
+        raise HTTPException(status_code=status.HTTP_403_FORBIDDEN,
+                            detail=f"The user {user_id} does not have the permission to access this resource.")
 
 
 def _guard_db(auth: WithUserId, token, permission: int, db: Session):
@@ -62,19 +140,51 @@ def _guard_db(auth: WithUserId, token, permission: int, db: Session):
     user_id = auth.user_id
     validate_user(user_id=user_id, token=token)
 
-    db_uploader = find_by(orm=User,
-                          attr="id",
-                          val=user_id,
-                          fail_detail=f"Failed to verify user {user_id}",
-                          db=db)
-
-    if not db_uploader.check_permission(permission=permission):
-        raise HTTPException(status_code=status.HTTP_403_FORBIDDEN,
-                            detail=f"The user {user_id} does not have the permission to access this resource.")
+    _check_permissions(user_id, _get_permissions(user_id=user_id, db=db), permission)
 
     return True
 
 
+def _guard_db_with_subject(auth: WithUserId,
+                           token,
+                           permission: int,
+                           subject_id,
+                           fail_detail: Optional[str] = None,
+                           db: Session = Depends(get_db)) -> User:
+    """
+    Same as _guard_db, and also find the user that the operation applies to. Unless
+    the operator's permissions are cached, both users are read in a single query.
+    :param auth: Data objects with user authorization details, including user_id and token.
+    :param permission: The target permission to check to allow this operation.
+    :param subject_id: The id of the user that the operation applies to.
+    :param fail_detail: The error message to display when the subject user is not found.
+    :param db: Database session.
+    :return: The subject user if permission is granted. Otherwise, an exception will be raised.
+    """
+    user_id = auth.user_id
+    validate_user(user_id=user_id, token=token)
+
+    permissions = _cached_permissions(user_id)
+    if permissions is not None:
+        _check_permissions(user_id, permissions, permission)
+        return find_by_pk(orm=User, pk=subject_id, fail_detail=fail_detail, db=db)
+
+    db_users = {db_user.id: db_user for db_user in db.execute(select(User).where(User.id.in_([user_id, subject_id]))).scalars()}
+
+    if user_id not in db_users:
+        raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail=f"Failed to verify user {user_id}")
+
+    _cache_permissions(user_id, db_users[user_id].permissions)
+    _check_permissions(user_id, db_users[user_id].permissions, permission)
+
+    if subject_id not in db_users:
+        if fail_detail is None:
+            fail_detail = f"{User.__name__} with id {str(subject_id)} is not found."
+        raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail=fail_detail)
+
+    return db_users[subject_id]
+
+
 def get_header_token(authorization: str = Header(...)):
     """
     Get Bearer JWT authorization token from Authorization header.
@@ -84,9 +194,70 @@ def get_header_token(authorization: str = Header(...)):
     if not authorization:
         raise HTTPException(status_code=status.HTTP_401_UNAUTHORIZED, detail="Missing authorization header.")
 
-    if not authorization.startswith("Bearer"):
+    # One slice compare, which also rejects "Bearer" without the space or without a token.
+    if authorization[:7] != "Bearer " or len(authorization) == 7:
         raise HTTPException(status_code=status.HTTP_401_UNAUTHORIZED, detail="Invalid token format.")
 
     token = authorization[7:]
 
     return token
+
+
+def rate_limit(times: int, seconds: int):
+    """
+    Create a dependency that lets each client, told apart by IP, make at most ``times``
+    requests in any ``seconds`` seconds. Others get 429. Counted in this process only.
+    :param times: Number of requests allowed in the window.
+    :param seconds: Length of the window in seconds.
+    :return: The dependency.
+    """
+    hits = {}   # Client IP -> times of its requests in the window, oldest first.
+    lock = threading.Lock()     # The limiter runs on the threadpool.
+
+    def limiter(request: Request):
+        now = time.monotonic()
+        client = request.client.host if request.client else "unknown"
+
+        with lock:
+            if client not in hits and len(hits) >= RATE_LIMIT_CLIENTS:
+                # Forget the clients that haven't requested within the window.
+                for key in [key for key, window in hits.items() if window[-1] <= now - seconds]:
+                    del hits[key]
+
+            window = hits.setdefault(client, deque())
+            while window and window[0] <= now - seconds:
+                window.popleft()
+
+            if len(window) >= times:
+                raise HTTPException(status_code=status.HTTP_429_TOO_MANY_REQUESTS,
+                                    detail="Too many requests. Please try again later.",
+                                    headers={"Retry-After": str(int(window[0] + seconds - now) + 1)})
+
+            window.append(now)
+
+    return limiter
+
+
+def get_current_user(token: str = Depends(get_header_token),
+                     db: Session = Depends(get_db)) -> User:
+    """
+    Get the user that the Bearer JWT authorization token belongs to. FastAPI runs a dependency
+    once per request, so the token is decoded and the user is read once however many times it's used.
+    :param token: Authorization JWT token.
+    :param db: Database session.
+    :return: The user of the token. If the token is invalid or its user doesn't exist, 401 will be raised.
+    """
+    payload = verify_jwt(token)
+    if payload is None:
+        raise credential_exception
+
+    try:
+        user_id = uuid.UUID(payload.get("user_id"))
+    except (TypeError, ValueError):
+        raise credential_exception
+
+    db_user = db.get(User, user_id)
+    if db_user is None:
+        raise credential_exception
+
+    return db_user